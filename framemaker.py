@@ -1,55 +1,507 @@
+import contextlib
+import json
+import math
+import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import bpy
 import numpy as np
 from PIL import Image
 
+try:
+    from numba import cuda, float32, njit, prange
+except ImportError:
+    cuda = njit = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    from skimage.color import rgb2lab as skimage_rgb2lab
+except ImportError:
+    skimage_rgb2lab = None
+
 
 # Color transformation formulae courtesy of https://www.easyrgb.com/en/math.php
 # Transforming from RGB to CIE L*a*b* colorspace makes it easier to calculate
 # differences in color that map more to how we perceive differences in color
-def rgb2xyz(rgb):
-    nrgb = rgb / 255
+_RGB_TO_XYZ = np.array([
+    [0.4124, 0.3576, 0.1805],
+    [0.2126, 0.7152, 0.0722],
+    [0.0193, 0.1192, 0.9505],
+], dtype=np.float32)
+# Observer = 2deg, Illuminant: D65
+_D65_REF = np.array([95.047, 100.0, 108.883], dtype=np.float32)
+# Linear RGB in [0, 1] straight to XYZ normalized by the reference white.
+_RGB_TO_NXYZ = _RGB_TO_XYZ * 100 / _D65_REF[:, None]
+# L*, a* and b* are linear in f(X), f(Y) and f(Z), up to an offset in L*.
+_F_XYZ_TO_LAB = np.array([
+    [0.0, 116.0, 0.0],
+    [500.0, -500.0, 0.0],
+    [0.0, 200.0, -200.0],
+], dtype=np.float32)
+_LAB_OFFSET = np.array([-16.0, 0.0, 0.0], dtype=np.float32)
 
-    positive_mask = nrgb > 0.04045
-    nrgb[positive_mask] = ((nrgb[positive_mask] + 0.055)  / 1.055) ** 2.4
-    negative_mask = ~positive_mask
-    nrgb[negative_mask] = nrgb[negative_mask] / 12.92
 
-    nrgb *= 100
+# sRGB gamma expansion of every possible 8-bit channel value, so that
+# uint8 images can be linearized with a lookup instead of a pow() per pixel.
+_SRGB_LUT = np.arange(256, dtype=np.float32) / 255
+_SRGB_LUT = np.where(
+    _SRGB_LUT > 0.04045, ((_SRGB_LUT + 0.055) / 1.055) ** 2.4, _SRGB_LUT / 12.92
+).astype(np.float32)
 
-    x = nrgb[:, :, 0] * 0.4124 + nrgb[:, :, 1] * 0.3576 + nrgb[:, :, 2] * 0.1805
-    y = nrgb[:, :, 0] * 0.2126 + nrgb[:, :, 1] * 0.7152 + nrgb[:, :, 2] * 0.0722
-    z = nrgb[:, :, 0] * 0.0193 + nrgb[:, :, 1] * 0.1192 + nrgb[:, :, 2] * 0.9505
 
-    return np.array([x, y, z]).transpose(1, 2, 0)
+def _srgb_to_linear(rgb):
+    if rgb.dtype == np.uint8:
+        return _SRGB_LUT[rgb]
 
+    # Work in float32 throughout; dividing by 255 would otherwise promote
+    # to float64 and double the size of every intermediate array.
+    nrgb = rgb.astype(np.float32) / 255
+    return np.where(nrgb > 0.04045, ((nrgb + 0.055) / 1.055) ** 2.4, nrgb / 12.92)
 
-def xyz2lab(xyz):
-    # Observer = 2deg, Illuminant: D65
-    ref = np.array([95.047, 100.0, 108.883])
-    nxyz = xyz / ref[None, None, :]
 
-    positive_mask = nxyz > 0.008856
-    nxyz[positive_mask] = nxyz[positive_mask] ** (1.0 / 3.0)
-    negative_mask = ~positive_mask
-    nxyz[negative_mask] = (nxyz[negative_mask] * 7.787) + (16.0 / 116.0)
+def rgb2xyz(rgb):
+    nrgb = _srgb_to_linear(rgb) * 100
+
+    return np.einsum("hwc,kc->hwk", nrgb, _RGB_TO_XYZ)
 
-    cie_l = 116.0 * nxyz[:, :, 1] - 16.0
-    cie_a = 500.0 * (nxyz[:, :, 0] - nxyz[:, :, 1])
-    cie_b = 200.0 * (nxyz[:, :, 1] - nxyz[:, :, 2])
 
-    return np.array([cie_l, cie_a, cie_b]).transpose(1, 2, 0)
+def xyz2lab(xyz):
+    nxyz = xyz / _D65_REF[None, None, :]
+
+    nxyz = np.where(nxyz > 0.008856, np.cbrt(nxyz), (nxyz * 7.787) + (16.0 / 116.0))
+
+    return nxyz @ _F_XYZ_TO_LAB.T + _LAB_OFFSET
 
 
 def rgb2lab(rgb):
-    return xyz2lab(rgb2xyz(rgb))
+    # Same as xyz2lab(rgb2xyz(rgb)), but the division by the reference
+    # white is folded into the RGB -> XYZ matrix, f(t) is applied in place
+    # and L*a*b* comes out of one more matrix product, instead of stacking
+    # and transposing whole XYZ and L*a*b* images in between.
+    nxyz = np.einsum("hwc,kc->hwk", _srgb_to_linear(rgb), _RGB_TO_NXYZ)
+
+    cube_mask = nxyz > 0.008856
+    np.cbrt(nxyz, out=nxyz, where=cube_mask)
+    np.invert(cube_mask, out=cube_mask)
+    np.multiply(nxyz, 7.787, out=nxyz, where=cube_mask)
+    np.add(nxyz, 16.0 / 116.0, out=nxyz, where=cube_mask)
+
+    lab = np.matmul(nxyz, _F_XYZ_TO_LAB.T)
+    lab += _LAB_OFFSET
+    return lab
+
+
+def _fast_rgb2lab(rgb):
+    """
+    Same as ``rgb2lab``, but hands the work off to OpenCV or scikit-image
+    when either is installed, since both have compiled implementations.
+    """
+    if cv2 is not None:
+        # Give OpenCV float32 input in [0, 1] so that it returns L in
+        # [0, 100] and a, b in about [-127, 127], like ``rgb2lab`` does.
+        # For uint8 input it would pack the channels into [0, 255] as
+        # (L * 255 / 100, a + 128, b + 128) instead.
+        return cv2.cvtColor(rgb.astype(np.float32) / 255, cv2.COLOR_RGB2LAB)
+    if skimage_rgb2lab is not None:
+        return skimage_rgb2lab(rgb)
+    return rgb2lab(rgb)
+
+
+# OKLab (https://bottosson.github.io/posts/oklab/) gives perceptual
+# distances that are as good as CIE L*a*b* for chroma keying, but it only
+# takes a matrix, a cube root and another matrix on linear RGB to get there.
+_LINEAR_SRGB_TO_LMS = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005],
+], dtype=np.float32)
+_LMS_TO_OKLAB = np.array([
+    [0.2104542553, 0.7936177850, -0.0040720468],
+    [1.9779984951, -2.4285922050, 0.4505937099],
+    [0.0259040371, 0.7827717662, -0.8086757660],
+], dtype=np.float32)
+
+
+# OKLab a and b span far less than CIE L*a*b* a* and b* do (about +-0.3
+# against +-100), so the chroma key scales OKLab differences back onto the
+# CIE L*a*b* scale before comparing them to chroma_pct. L only goes from
+# [0, 1] to [0, 100]. The a and b scale was measured by matching how many
+# colors of the RGB cube each colorspace keys out around a few dozen
+# different background colors.
+_OKLAB_L_SCALE = 100.0
+_OKLAB_AB_SCALE = 375.0
+_OKLAB_TO_LAB_SCALE = np.array(
+    [_OKLAB_L_SCALE, _OKLAB_AB_SCALE, _OKLAB_AB_SCALE], dtype=np.float32
+)
+
+
+def rgb2oklab(rgb):
+    lms = np.cbrt(_srgb_to_linear(rgb) @ _LINEAR_SRGB_TO_LMS.T)
+    return lms @ _LMS_TO_OKLAB.T
+
+
+def _scaled_rgb2oklab(rgb):
+    return rgb2oklab(rgb) * _OKLAB_TO_LAB_SCALE
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _linear_rgb_to_oklab(nr, ng, nb):
+        """
+        Scalar version of ``rgb2oklab`` for a single pixel that has
+        already been through the sRGB gamma expansion.
+        """
+        lms_l = np.cbrt(0.4122214708 * nr + 0.5363325363 * ng + 0.0514459929 * nb)
+        lms_m = np.cbrt(0.2119034982 * nr + 0.6806995451 * ng + 0.1073969566 * nb)
+        lms_s = np.cbrt(0.0883024619 * nr + 0.2817188376 * ng + 0.6299787005 * nb)
+
+        return (
+            0.2104542553 * lms_l + 0.7936177850 * lms_m - 0.0040720468 * lms_s,
+            1.9779984951 * lms_l - 2.4285922050 * lms_m + 0.4505937099 * lms_s,
+            0.0259040371 * lms_l + 0.7827717662 * lms_m - 0.8086757660 * lms_s,
+        )
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _oklab_chroma_key(pixels_u8, srgb_lut, ref_l, ref_a, ref_b, l_scale, ab_scale, threshold):
+        height, width = pixels_u8.shape[:2]
+        for row in prange(height):
+            for col in range(width):
+                ok_l, ok_a, ok_b = _linear_rgb_to_oklab(
+                    srgb_lut[pixels_u8[row, col, 0]],
+                    srgb_lut[pixels_u8[row, col, 1]],
+                    srgb_lut[pixels_u8[row, col, 2]]
+                )
+                dl = (ok_l - ref_l) * l_scale
+                da = (ok_a - ref_a) * ab_scale
+                db = (ok_b - ref_b) * ab_scale
+                if dl * dl + da * da + db * db < threshold:
+                    pixels_u8[row, col, 3] = 0
+
+    def rgb_to_chroma_mask(pixels_u8, chroma_pct, bg):
+        """
+        Fused, in-place version of the OKLab chroma key in
+        ``make_anim_sheet``.
+
+        Every pixel whose OKLab distance to the background color ``bg``,
+        scaled to CIE L*a*b* units, is below ``chroma_pct`` gets its
+        alpha set to 0. The sRGB gamma expansion is a lookup in
+        ``_SRGB_LUT``, and all the other intermediate color values live
+        in registers, so no temporary arrays are allocated.
+        """
+        ref_l, ref_a, ref_b = rgb2oklab(bg[None, None, :])[0, 0]
+        _oklab_chroma_key(
+            pixels_u8, _SRGB_LUT,
+            float(ref_l), float(ref_a), float(ref_b),
+            _OKLAB_L_SCALE, _OKLAB_AB_SCALE,
+            chroma_pct ** 2
+        )
+
+
+if cuda is not None:
+    @cuda.jit
+    def _oklab_chroma_kernel(pixels_u8, srgb_lut, ref_l, ref_a, ref_b, l_scale, ab_scale, threshold):
+        # x is the fastest-varying thread index, so put it on columns to
+        # keep the loads and stores of a warp coalesced.
+        col, row = cuda.grid(2)
+        if row >= pixels_u8.shape[0] or col >= pixels_u8.shape[1]:
+            return
+
+        # The lookup table takes care of the sRGB gamma expansion, and
+        # LMS values of linear RGB are never negative, so the whole
+        # conversion is branch free. Every constant is cast to float32;
+        # bare Python floats would push the math to FP64, which consumer
+        # GPUs run at a fraction of the FP32 rate.
+        nr = srgb_lut[pixels_u8[row, col, 0]]
+        ng = srgb_lut[pixels_u8[row, col, 1]]
+        nb = srgb_lut[pixels_u8[row, col, 2]]
+
+        one_third = float32(1.0 / 3.0)
+        lms_l = (
+            float32(0.4122214708) * nr + float32(0.5363325363) * ng + float32(0.0514459929) * nb
+        ) ** one_third
+        lms_m = (
+            float32(0.2119034982) * nr + float32(0.6806995451) * ng + float32(0.1073969566) * nb
+        ) ** one_third
+        lms_s = (
+            float32(0.0883024619) * nr + float32(0.2817188376) * ng + float32(0.6299787005) * nb
+        ) ** one_third
+
+        dl = (
+            float32(0.2104542553) * lms_l + float32(0.7936177850) * lms_m
+            - float32(0.0040720468) * lms_s - ref_l
+        ) * l_scale
+        da = (
+            float32(1.9779984951) * lms_l - float32(2.4285922050) * lms_m
+            + float32(0.4505937099) * lms_s - ref_a
+        ) * ab_scale
+        db = (
+            float32(0.0259040371) * lms_l + float32(0.7827717662) * lms_m
+            - float32(0.8086757660) * lms_s - ref_b
+        ) * ab_scale
+        if dl * dl + da * da + db * db < threshold:
+            pixels_u8[row, col, 3] = 0
+
+    def rgb_to_chroma_mask_cuda(pixels_u8, chroma_pct, bg):
+        """
+        GPU version of ``rgb_to_chroma_mask``, which keys out the
+        background color ``bg`` of the RGBA array ``pixels_u8`` in place.
+        """
+        height, width = pixels_u8.shape[:2]
+        ref_l, ref_a, ref_b = rgb2oklab(bg[None, None, :])[0, 0]
+
+        threads = (16, 16)
+        blocks = ((width + threads[0] - 1) // threads[0], (height + threads[1] - 1) // threads[1])
+
+        device_pixels = cuda.to_device(pixels_u8)
+        _oklab_chroma_kernel[blocks, threads](
+            device_pixels,
+            cuda.to_device(_SRGB_LUT),
+            np.float32(ref_l), np.float32(ref_a), np.float32(ref_b),
+            np.float32(_OKLAB_L_SCALE), np.float32(_OKLAB_AB_SCALE),
+            np.float32(chroma_pct ** 2)
+        )
+        device_pixels.copy_to_host(pixels_u8)
+
+
+def _ratio_key_channel(bg):
+    """
+    Return the channel that dominates the background color ``bg``, the
+    other two channels, and the background's score for
+    ``ratio_chroma_mask``. Raises a ``ValueError`` if no channel clearly
+    dominates.
+    """
+    bg = np.asarray(bg, dtype=np.float32)
+    key = int(np.argmax(bg))
+    others = [channel for channel in range(3) if channel != key]
+
+    bg_score = ((bg[others[0]] - bg[key]) + (bg[others[1]] - bg[key])) / 255
+    if bg_score > -0.1:
+        # Gray, white or black backgrounds have no dominant channel, and
+        # the score would key out whatever happens to lean towards red.
+        raise ValueError(
+            f"Background color {bg.astype(int).tolist()} is not dominated by "
+            f"a single channel, so it can't be keyed out with the \"ratio\" "
+            f"method. Use \"oklab\" or \"lab\" instead."
+        )
+    return key, others, bg_score
+
+
+def ratio_chroma_mask(rgb, chroma_pct, bg=None):
+    """
+    Cheap chroma key for saturated backgrounds, like a green screen, that
+    skips colorspace conversions altogether.
+
+    The channel that dominates the background color ``bg`` (pixel (0, 0)
+    by default) is the key channel. Every pixel gets a score of how far
+    the other two channels fall below the key channel, and pixels whose
+    score is within ``chroma_pct`` percent of the background's score are
+    masked out. The score uses channel differences rather than ratios, so
+    that dark pixels, where the ratios blow up, don't get keyed out by
+    accident.
+
+    Raises a ``ValueError`` if no channel clearly dominates ``bg``.
+    """
+    if bg is None:
+        bg = rgb[0, 0]
+    key, others, bg_score = _ratio_key_channel(bg)
+
+    key_channel = rgb[:, :, key].astype(np.float32)
+    score = (
+        (rgb[:, :, others[0]] - key_channel) +
+        (rgb[:, :, others[1]] - key_channel)
+    ) / 255
+    return score < bg_score * (1.0 - chroma_pct / 100.0)
+
+
+# Assume a conservative 1 MB of L2 cache when splitting up the chroma key.
+_L2_BYTES = 1 << 20
+
+
+# Corners whose channels are all within this many levels of each other
+# count as the same color, so that dithering doesn't split them up.
+_CORNER_TOLERANCE = 3
+
+
+def _background_color(rgb):
+    """
+    Pick the most common color among the four corners of ``rgb`` as the
+    background color to key out, so that a border or letterbox in one
+    corner doesn't silently throw off the chroma key. Ties go to the
+    top-left corner.
+
+    Corners match when they are within ``_CORNER_TOLERANCE`` levels on
+    every channel, and the median of the largest group of matching
+    corners is returned.
+    """
+    corners = rgb[[0, 0, -1, -1], [0, -1, 0, -1]].astype(np.int16)
+    close = np.abs(corners[:, None, :] - corners[None, :, :]).max(axis=2) <= _CORNER_TOLERANCE
+    cluster = corners[close[np.argmax(close.sum(axis=1))]]
+    return np.median(cluster, axis=0).round().astype(np.uint8)
+
+
+def _chroma_mask(rgb, chroma_pct, method, bg):
+    """
+    Return a boolean mask of the pixels in ``rgb`` that match the
+    background color ``bg``. See ``make_anim_sheet`` for the meaning of
+    ``chroma_pct`` and ``method``.
+
+    The work is done in bands of rows small enough for the float32 color
+    conversion of a band, and its difference from the background, to stay
+    in L2 cache, rather than making several passes over sheet-sized
+    temporaries.
+    """
+    height, width = rgb.shape[:2]
+    rows_per_tile = max(1, _L2_BYTES // (width * 3 * 4 * 2))
+
+    if method != "ratio":
+        # Convert the background color and square the threshold just once,
+        # rather than for every band.
+        convert = _scaled_rgb2oklab if method == "oklab" else _fast_rgb2lab
+        chroma = convert(bg[None, None, :])
+        threshold = chroma_pct ** 2
+
+    chroma_mask = np.empty((height, width), dtype=bool)
+    for top in range(0, height, rows_per_tile):
+        band = rgb[top:top + rows_per_tile]
+        if method == "ratio":
+            chroma_mask[top:top + rows_per_tile] = ratio_chroma_mask(band, chroma_pct, bg)
+        else:
+            diff = convert(band) - chroma
+            chroma_mask[top:top + rows_per_tile] = (
+                np.einsum("hwc,hwc->hw", diff, diff) < threshold
+            )
+    return chroma_mask
+
+
+def _is_plain_srgb_view(scene):
+    """
+    Whether the scene's color management boils down to the plain sRGB
+    transfer function, which is all ``_blit_frame`` applies to the raw
+    render. Anything else (Filmic, AgX, looks, exposure, curves...) is
+    only applied by Blender when it writes the render out to a file.
+    """
+    view = scene.view_settings
+    image_settings = scene.render.image_settings
+    return (
+        getattr(image_settings, "color_management", "FOLLOW_SCENE") == "FOLLOW_SCENE" and
+        scene.display_settings.display_device == "sRGB" and
+        view.view_transform == "Standard" and
+        view.look == "None" and
+        view.exposure == 0.0 and
+        view.gamma == 1.0 and
+        not view.use_curve_mapping
+    )
+
+
+def _viewer_source(tree):
+    """
+    Find the socket in the compositor ``tree`` whose output ends up in the
+    render: whatever feeds the Composite node, or else the Render Layers
+    node. Returns None if the tree has neither.
+    """
+    composite = next((node for node in tree.nodes if node.type == "COMPOSITE"), None)
+    if composite is not None and composite.inputs["Image"].is_linked:
+        return composite.inputs["Image"].links[0].from_socket
+
+    render_layers = next((node for node in tree.nodes if node.type == "R_LAYERS"), None)
+    if render_layers is None:
+        return None
+    return render_layers.outputs["Image"]
+
+
+@contextlib.contextmanager
+def _viewer_node(scene):
+    """
+    Blender doesn't expose the pixels of the "Render Result" image to
+    Python, so hook a Viewer node up to whatever feeds the compositor
+    output. Its image gets refreshed on every render, and we can read it
+    straight out of memory instead of going through a PNG on disk.
+
+    Every node this adds to the compositor, including the default tree
+    that turning on ``use_nodes`` creates, is removed again on exit.
+    """
+    use_nodes = scene.use_nodes
+    original_nodes = set(scene.node_tree.nodes.keys()) if scene.node_tree is not None else set()
+
+    scene.use_nodes = True
+    tree = scene.node_tree
+    try:
+        source = _viewer_source(tree)
+        if source is None:
+            raise ValueError(
+                "The compositor has neither a linked Composite node nor a "
+                "Render Layers node to hook the Viewer node up to."
+            )
+
+        viewer = tree.nodes.new("CompositorNodeViewer")
+        tree.links.new(source, viewer.inputs["Image"])
+        yield viewer
+    finally:
+        for node in list(tree.nodes):
+            if node.name not in original_nodes:
+                tree.nodes.remove(node)
+        scene.use_nodes = use_nodes
+
+
+def _grab_viewer_pixels(pixels):
+    """
+    Copy the last render out of the Viewer node into the flat float32
+    array ``pixels``, reallocating it if the render size changed. This
+    touches bpy, so it has to run on the main thread.
+
+    Returns the filled array along with the (width, height) of the render.
+    """
+    viewer_image = bpy.data.images["Viewer Node"]
+    width, height = viewer_image.size
+
+    if pixels is None or pixels.size != width * height * 4:
+        pixels = np.empty(width * height * 4, dtype=np.float32)
+    viewer_image.pixels.foreach_get(pixels)
+    return pixels, (width, height)
+
+
+def _blit_frame(sheet, pixels, size, x_offset, y_offset):
+    """
+    Convert raw Viewer node pixels to 8-bit RGBA and copy them into
+    ``sheet``, with the first row at the top of the frame.
+    """
+    width, height = size
+    frame = np.clip(pixels.reshape(height, width, 4)[::-1], 0.0, 1.0)
+
+    # The Viewer node holds premultiplied, scene-linear values, while PNGs
+    # get straight alpha and the sRGB transfer function. Only plain sRGB
+    # views make it this far, see ``_is_plain_srgb_view``.
+    rgb = frame[:, :, :3]
+    alpha = frame[:, :, 3:]
+    np.divide(rgb, alpha, out=rgb, where=alpha > 0.0)
+    np.minimum(rgb, 1.0, out=rgb)
+    frame[:, :, :3] = np.where(
+        rgb > 0.0031308, 1.055 * rgb ** (1.0 / 2.4) - 0.055, rgb * 12.92
+    )
+
+    sheet[y_offset:y_offset + height, x_offset:x_offset + width] = frame * 255 + 0.5
+
+
+def _blit_image(sheet, image, x_offset, y_offset):
+    """
+    Decode a frame that Blender wrote to disk and copy it into ``sheet``.
+    """
+    with image:
+        frame = np.asarray(image.convert("RGBA"))
+    height, width = frame.shape[:2]
+    sheet[y_offset:y_offset + height, x_offset:x_offset + width] = frame
 
 
 def make_anim_sheet(
     frame_width: int, frame_height: int,
     output_fname: str,
-    chroma_pct: float = 20.0
+    chroma_pct: float = 20.0,
+    method: str = "oklab"
 ) -> None:
     """
     Make an animation sheet that turns the current model into a
@@ -58,55 +510,149 @@ def make_anim_sheet(
     It assumes that the given scene has cameras named
     "view-xxx", where xxx is any number, and will generate frames
     for every camera.
+
+    The background is keyed out by measuring color distances in the
+    colorspace given by ``method``, either "oklab" or "lab" (CIE L*a*b*).
+    ``chroma_pct`` is the distance threshold in CIE L*a*b* units, i.e. as
+    a percentage of the lightness range. OKLab distances are scaled to
+    match, so that both key out about as many colors.
+    For a saturated background like a green screen, ``method="ratio"``
+    uses the much cheaper ``ratio_chroma_mask`` instead.
+
+    Next to the sheet, this also writes a JSON manifest named after
+    ``output_fname`` with a ".json" suffix appended, which maps every
+    frame number to the [x, y, width, height] of that frame in the sheet.
     """
+    if method not in ("oklab", "lab", "ratio"):
+        raise ValueError(f"Unknown chroma key method: {method}")
 
     bpy.context.scene.render.resolution_x = frame_width
     bpy.context.scene.render.resolution_y = frame_height
 
-    _, working_fname = tempfile.mkstemp(suffix=".png")
-    bpy.context.scene.render.filepath = working_fname
-
     n_frames = bpy.context.scene.frame_end - bpy.context.scene.frame_start + 1
 
     # Pack the frames together in the most compact grid shape.
-    grid_size = 1
-    while grid_size ** 2 < n_frames:
-        grid_size += 1
+    grid_size = math.isqrt(n_frames - 1) + 1 if n_frames > 0 else 1
 
     sheet_width = grid_size * frame_width
     sheet_height = grid_size * frame_height
-    output_image = Image.new("RGBA", (sheet_width, sheet_height))
+    sheet = np.zeros((sheet_height, sheet_width, 4), dtype=np.uint8)
 
-    for frame_num in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end + 1):
-        bpy.context.scene.frame_set(frame_num)
-        bpy.ops.render.render(False, write_still=True)
-        frame_image = Image.open(working_fname)
+    # Reading frames straight from memory skips Blender's color
+    # management, so only do that when it would have been a no-op anyway.
+    # It also relies on the compositor refreshing the Viewer node, which
+    # doesn't happen with compositing turned off, and on there being
+    # something in the compositor to hook it up to. Otherwise let Blender
+    # write every frame to a PNG, alternating between two files so that the
+    # worker below never reads a file that is being written.
+    in_memory = (
+        bpy.context.scene.render.use_compositing and
+        _is_plain_srgb_view(bpy.context.scene) and
+        # A scene without a compositor tree gets the default one, which
+        # always has a Render Layers node.
+        (
+            bpy.context.scene.node_tree is None or
+            _viewer_source(bpy.context.scene.node_tree) is not None
+        )
+    )
+    filepath = bpy.context.scene.render.filepath
+    working_fnames = []
+    if not in_memory:
+        for _ in range(2):
+            fd, working_fname = tempfile.mkstemp(suffix=".png")
+            os.close(fd)
+            working_fnames.append(working_fname)
 
-        x_offset = (frame_num % grid_size) * frame_width
-        y_offset = (frame_num // grid_size) * frame_height
+    # Rendering has to stay on the main thread, but decoding, converting
+    # and copying frame N into the sheet can run on a worker while frame
+    # N + 1 renders. The two pixel buffers take turns for the same reason
+    # as the files above.
+    buffers = [None, None]
+    pending = None
+    manifest = {}
+    try:
+        with contextlib.ExitStack() as stack:
+            if in_memory:
+                stack.enter_context(_viewer_node(bpy.context.scene))
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=1))
 
-        output_image.paste(frame_image, (x_offset, y_offset))
+            for frame_num in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end + 1):
+                bpy.context.scene.frame_set(frame_num)
+                frame_idx = frame_num - bpy.context.scene.frame_start
 
-    # before saving the image, chroma out the background
-    output_pixels = np.array(output_image)
-    output_pixels_lab = rgb2lab(output_pixels[:, :, :3])
+                if in_memory:
+                    bpy.ops.render.render(False, write_still=False)
+                    buffers[frame_idx % 2], size = _grab_viewer_pixels(buffers[frame_idx % 2])
+                else:
+                    bpy.context.scene.render.filepath = working_fnames[frame_idx % 2]
+                    bpy.ops.render.render(False, write_still=True)
+                    # Only reads the header; the worker does the decoding.
+                    frame_image = Image.open(working_fnames[frame_idx % 2])
+                    size = frame_image.size
+
+                x_offset = (frame_idx % grid_size) * frame_width
+                y_offset = (frame_idx // grid_size) * frame_height
+                manifest[frame_num] = [x_offset, y_offset, *size]
+
+                if pending is not None:
+                    pending.result()
+                if in_memory:
+                    pending = executor.submit(
+                        _blit_frame, sheet, buffers[frame_idx % 2], size, x_offset, y_offset
+                    )
+                else:
+                    pending = executor.submit(
+                        _blit_image, sheet, frame_image, x_offset, y_offset
+                    )
 
-    chroma = output_pixels_lab[0, 0, :]
-    norms = np.linalg.norm(output_pixels_lab - chroma[None, None, :], axis=2)
-    print(norms.max())
-    print(norms.min())
-    chroma_mask = norms < chroma_pct
-    output_pixels[chroma_mask] = np.array([0, 0, 0, 0])
+                if frame_idx == 0:
+                    # Sample the background from the corners of the first
+                    # frame, since the last cells of the sheet may be left
+                    # empty. Do it right away, so that a background the
+                    # chroma key can't handle fails before rendering the
+                    # rest of the frames.
+                    pending.result()
+                    width, height = size
+                    bg = _background_color(sheet[:height, :width, :3])
+                    if method == "ratio":
+                        _ratio_key_channel(bg)
+
+            if pending is not None:
+                pending.result()
+    finally:
+        bpy.context.scene.render.filepath = filepath
+        for working_fname in working_fnames:
+            os.remove(working_fname)
+
+    # before saving the image, chroma out the background
+    output_pixels = sheet
+    chroma_mask = None
+    if method == "oklab" and cuda is not None and cuda.is_available():
+        rgb_to_chroma_mask_cuda(output_pixels, chroma_pct, bg)
+    elif method == "oklab" and njit is not None:
+        rgb_to_chroma_mask(output_pixels, chroma_pct, bg)
+    else:
+        chroma_mask = _chroma_mask(output_pixels[:, :, :3], chroma_pct, method, bg)
 
     final_output_image = Image.fromarray(output_pixels)
+    if chroma_mask is not None:
+        # Like the kernels, only clear the alpha of the keyed pixels, and
+        # let Pillow do it in C rather than scattering through a boolean
+        # index in NumPy.
+        alpha = final_output_image.getchannel("A")
+        alpha.paste(0, mask=Image.fromarray(chroma_mask))
+        final_output_image.putalpha(alpha)
     final_output_image.save(output_fname)
+    with open(output_fname + ".json", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
 
 
 def snap_panorama(
     frame_width: int, frame_height: int,
     fname_prefix: str,
     chroma_pct: float = 20.0,
-    file_ext: str = "png"
+    file_ext: str = "png",
+    method: str = "oklab"
 ):
     """
     Go through every camera and generate spritesheets from
@@ -124,5 +670,6 @@ def snap_panorama(
             frame_width,
             frame_height,
             fname,
-            chroma_pct
+            chroma_pct,
+            method
         )
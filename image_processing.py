@@ -1,9 +1,12 @@
 import arguably
+import json
+import math
 import os
 import re
 
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
+import numpy as np
 from PIL import Image
 
 
@@ -12,7 +15,10 @@ def make_spritesheets(individual_sprite_dir, output_dir):
     """
     Given a directory of individual sprites representing views of
     the same building(s), output sprite sheets for each view of
-    all buildings, and try to keep them sorted by name.
+    all buildings. Sprites are packed tallest-first to keep the sheets
+    small, so every sheet also gets a JSON manifest next to it (e.g.
+    view-0.png.json) that maps each building name to the
+    [x, y, width, height] of its sprite in the sheet.
 
     All sprite image filenames must end with the "-view-xx.png"
     suffix, where xx is any number.
@@ -60,12 +66,15 @@ def make_spritesheets(individual_sprite_dir, output_dir):
             Image.open(os.path.join(individual_sprite_dir, spec["file"]))
             for spec in buildings_array
         ]
-        smallest_width = min([img.size[0] for img in loaded_images])
-        smallest_height = min([img.size[1] for img in loaded_images])
+        # Image.open only reads the header, so none of the pixel data gets
+        # decoded until a sprite is actually copied into the sheet.
+        sizes = [img.size for img in loaded_images]
+        smallest_width = min(width for width, _ in sizes)
+        smallest_height = min(height for _, height in sizes)
 
         if (
-            any([(img.size[0] % smallest_width) > 0 for img in loaded_images]) or
-            any([img.size[1] % smallest_height > 0 for img in loaded_images])
+            any(width % smallest_width for width, _ in sizes) or
+            any(height % smallest_height for _, height in sizes)
         ):
             raise ValueError(
                 f"Dimensions of smallest image for view {view_angle} do not "
@@ -74,87 +83,78 @@ def make_spritesheets(individual_sprite_dir, output_dir):
                 f"{smallest_width}, smallest height: {smallest_height}"
             )
 
-        # Implement the naive row-packing algorithm as described in this
+        # Implement a row-packing algorithm along the lines of this
         # excellent blog by David Colson:
         # https://www.david-colson.com/2020/03/10/exploring-rect-packing.html
         # who ran into a very similar issue that I'm facing here. We have a little
         # bit of a wrinkle here in that we have to figure out the size of the
-        # box we're packing our sprites into first.
-        packing_order, sheet_size = _squarify([img.size for img in loaded_images])
-        output_image = Image.new(mode="RGBA", size=sheet_size)
-
+        # box we're packing our sprites into first, which we take to be a
+        # square with the same area as all the sprites.
+        packing_order, sheet_size = _squarify(sizes)
+        sheet = np.zeros((sheet_size[1], sheet_size[0], 4), dtype=np.uint8)
+
+        # Sprites end up wherever they pack best rather than in name order,
+        # so keep track of where each building went.
+        manifest = {}
         anchor = (0, 0)
         for row in packing_order:
             max_height = 0
             for idx in row:
                 img = loaded_images[idx]
-                width, height = img.size
-                output_image.paste(img, anchor)
+                width, height = sizes[idx]
+                sheet[
+                    anchor[1]:anchor[1] + height,
+                    anchor[0]:anchor[0] + width
+                ] = np.asarray(img.convert("RGBA"))
+                manifest[buildings_array[idx]["building"]] = [
+                    anchor[0], anchor[1], width, height
+                ]
                 anchor = (anchor[0] + width, anchor[1])
                 max_height = max([max_height, height])
 
             anchor = (0, anchor[1] + max_height)
 
-        output_image.save(os.path.join(output_dir, f"view-{view_angle}.png"))
+        output_fname = os.path.join(output_dir, f"view-{view_angle}.png")
+        output_image = Image.fromarray(sheet)
+        output_image.save(output_fname)
+        with open(output_fname + ".json", "w") as manifest_file:
+            json.dump(dict(sorted(manifest.items())), manifest_file, indent=2)
 
 
 def _squarify(sizes):
     """
     Given a list of tuples of (width, height), return a list of lists
-    of indices indicating how to pack these into a squarish box.
+    of indices indicating how to pack these into a squarish box, along
+    with the (width, height) of that box.
+
+    This is the first-fit decreasing height (FFDH) heuristic: going from
+    the tallest sprite to the shortest (widest first among sprites of the
+    same height), put each one in the first row that still has room for
+    it, where rows are as wide as a square with the same area as all the
+    sprites combined. Since the sprites come in tallest-first, the first
+    sprite in a row sets the height of that row.
     """
-    # Sort by width, then by height
-    idx_array = list(range(len(sizes)))
-    zipped = list(zip(sizes, idx_array))
-    zipped = sorted(zipped, key=lambda e: e[0][0])
-    zipped = sorted(zipped, key=lambda e: e[0][1])
-    sizes, idx_array = zip(*zipped)
-
-    min_unsquareness = float("inf")
-    output_array = [idx_array]
-    output_size = (
-        max([size[0] for size in sizes]),
-        max([size[1] for size in sizes])
-    )
-    for row_split in range(len(sizes), 0, -1):
-        row_width = sum([sizes[idx][0] for idx in range(row_split)])
-
-        current_sheet = []
-        current_row = []
-        current_row_width = 0
-        current_height = 0
-
-        max_height = 0
-        max_width = 0
-        for idx, (width, height) in zip(idx_array, sizes):
-            max_height = max([max_height, height])
-            current_row_width += width
-            current_row.append(idx)
-
-            if current_row_width >= row_width:
-                current_sheet.append(current_row)
-                current_height += max_height
-                max_width = max([max_width, current_row_width])
-                max_height = 0
-                current_row = []
-                current_row_width = 0
-
-        if len(current_row) > 0:
-            current_sheet.append(current_row)
-            current_height += max_height
-
-        # Now check how square this is.
-        unsquareness = abs(max_width - current_height)
-        if unsquareness > min_unsquareness:
-            # Unsquareness is starting to increase, so break here.
-            # Don't change the output sheet.
-            break
+    idx_array = sorted(range(len(sizes)), key=lambda idx: (-sizes[idx][1], -sizes[idx][0]))
+    target_width = math.ceil(math.sqrt(sum([width * height for width, height in sizes])))
+
+    output_array = []
+    row_widths = []
+    row_heights = []
+    for idx in idx_array:
+        width, height = sizes[idx]
+        for row_num, row_width in enumerate(row_widths):
+            if row_width + width <= target_width:
+                output_array[row_num].append(idx)
+                row_widths[row_num] += width
+                break
         else:
-            # Unsquareness is decreasing. Save this output sheet
-            # and continue iterating.
-            min_unsquareness = unsquareness
-            output_array = current_sheet
-            output_size = max_width, current_height
+            # Doesn't fit anywhere (or is wider than the target on its
+            # own), so it starts a new row.
+            output_array.append([idx])
+            row_widths.append(width)
+            row_heights.append(height)
+
+    output_size = (max(row_widths, default=0), sum(row_heights))
     return output_array, output_size
 
 